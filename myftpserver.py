@@ -1,7 +1,16 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import logging.handlers
+import mmap
 import os
-import re
+import pathlib
+import queue
 import socket
-import threading
+import sys
+from dataclasses import dataclass
 
 
 # '0.0.0.0' to bind to all interfaces
@@ -9,15 +18,44 @@ ADDRESS = '0.0.0.0'
 # default port for FTP control connection
 PORT = 21
 
-# receive / transmit buffer size
-BUFFER_SIZE = 2048
+# receive / transmit buffer size for the control connection
+CONTROL_BUFFER_SIZE = 2048
+# chunk size for file transfers over the data connection
+DATA_BUFFER_SIZE = 1 << 16
+# kernel send / receive buffer size of the data connection socket
+DATA_SOCKET_BUFFER_SIZE = 1 << 20
+# maximum number of threads running blocking file system calls
+FILE_IO_WORKERS = 32
 # encoding to use for sending / receiving messages
 ENCODING = 'utf-8'
 # path in the file system where the server started
 BASE_PATH = os.getcwd()
-# currently supported commands
-SUPPORTED_COMMANDS = ['OPTS', 'USER', 'PASS', 'QUIT',
-                      'XPWD', 'CWD', 'DELE', 'PORT', 'RETR', 'STOR']
+# canonical form of BASE_PATH, comparable with the resolved paths sent by clients
+BASE_PURE_PATH = pathlib.PurePath(os.path.realpath(BASE_PATH))
+# CPU to pin the server to, e.g. the one handling the NIC queue; unpinned if not set
+SERVER_CPU = os.environ.get('SERVER_CPU')
+# commands supported before the client is authenticated
+UNAUTHENTICATED_COMMANDS = frozenset({b'OPTS', b'USER', b'PASS', b'QUIT'})
+# TCP_QUICKACK is Linux only
+TCP_QUICKACK_SUPPORTED = hasattr(socket, 'TCP_QUICKACK')
+# TCP_CORK is Linux only
+TCP_CORK_SUPPORTED = hasattr(socket, 'TCP_CORK')
+
+# pre-encoded replies with a fixed text
+REPLY_220_WELCOME = b'220 Welcome to myFTPserver!\r\n'
+REPLY_504_NOT_IMPLEMENTED_FOR_ARG = b'504 Command not implemented for that argument.\r\n'
+REPLY_200_OK = b'200 OK\r\n'
+REPLY_331_NEED_PASSWORD = b'331 Username OK, need password.\r\n'
+REPLY_230_LOGGED_IN = b'230 Login successful.\r\n'
+REPLY_530_INCORRECT_CREDENTIALS = b'530 Not logged in. Incorrect credentials.\r\n'
+REPLY_221_GOODBYE = b'221 Goodbye.\r\n'
+REPLY_530_NOT_LOGGED_IN = b'530 Not logged in.\r\n'
+REPLY_502_NOT_IMPLEMENTED = b'502 Command not implemented.\r\n'
+REPLY_200_COMMAND_SUCCESSFUL = b'200 Command successful.\r\n'
+REPLY_501_SYNTAX_ERROR = b'501 Syntax error in parameters or arguments.\r\n'
+REPLY_503_BAD_SEQUENCE = b'503 Bad sequence of commands.\r\n'
+REPLY_425_CANT_OPEN_DATA_CNX = b"425 Can't open data connection.\r\n"
+REPLY_150_ABOUT_TO_TRANSFER = b'150 File status okay; about to begin transfer.\r\n'
 
 # socket for the exchange of commands and replies
 control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -26,376 +64,673 @@ control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 # bind the socket to the address and port
 control_socket.bind((ADDRESS, PORT))
 
+# number of clients currently connected
+active_connections = 0
+
+# log records are queued here and written out by a background thread
+log_queue = queue.SimpleQueue()
+logger = logging.getLogger('myftpserver')
+
 
-def send_message(cnx, message):
-    ''' Sends message to the client
+def quickack(writer):
+    ''' Acknowledges the next command from the client without the delayed ACK timer
+
+    The kernel leaves quick ACK mode on its own, so it is re-enabled after every reply.
+    Only available on Linux; a no-op elsewhere.
 
     Arguments:
-        cnx: control socket connection with the client
-        message: message to send to the client over the connection
+        writer: stream writer of the control connection with the client
     '''
 
-    cnx.send(f'{message}\r\n'.encode(ENCODING))
+    if TCP_QUICKACK_SUPPORTED:
+        writer.get_extra_info('socket').setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
 
 
-def close_cnx(cnx):
-    ''' Closes the connection with the client
+async def send_bytes(writer, reply):
+    ''' Sends an encoded reply to the client
 
     Arguments:
-        cnx: control socket connection with the client
+        writer: stream writer of the control connection with the client
+        reply: encoded reply terminated by CRLF, e.g. REPLY_200_OK
     '''
 
-    cnx.close()
-    print('[SERVER] Client disconnected.')
+    writer.write(reply)
+    await writer.drain()
+    quickack(writer)
 
 
-def connect_to_client(client_info):
-    ''' Establishes a data connection with the client
+def close_cnx(writer):
+    ''' Closes the connection with the client
 
     Arguments:
-        client_info: address sent by the client (h1,h2,h3,h4,p1,p2)
+        writer: stream writer of the control connection with the client
+    '''
+
+    writer.close()
+    logger.info('Client disconnected.')
+
+
+def create_data_socket():
+    ''' Creates a non-blocking socket tuned for bulk file transfers
 
     Returns:
-        socket | None : data communication socket if connected to the client else None
+        socket : unconnected data communication socket
     '''
 
-    # client_address = h1.h2.h3.h4
-    client_address = '.'.join(client_info[:4])
-    # client_port = (p1 * 256) + p2
-    client_port = int(client_info[4]) * 256 + int(client_info[5])
-
     # socket for the exchange of data
     data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # enlarge the kernel buffers for bulk transfers; set before connecting so
+    # the TCP window scale is negotiated accordingly
+    data_socket.setsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVBUF, DATA_SOCKET_BUFFER_SIZE)
+    data_socket.setsockopt(
+        socket.SOL_SOCKET, socket.SO_SNDBUF, DATA_SOCKET_BUFFER_SIZE)
+
+    # only send full segments; the pending partial one is flushed when the
+    # data connection is closed after the transfer (Linux only)
+    if TCP_CORK_SUPPORTED:
+        data_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    data_socket.setblocking(False)
+
+    return data_socket
+
+
+async def connect_to_client(client_address):
+    ''' Establishes a data connection with the client
+
+    Arguments:
+        client_address: (host, port) parsed from the PORT command
+
+    Returns:
+        (StreamReader, StreamWriter) | None : data connection streams if connected to the client else None
+    '''
+
+    data_socket = create_data_socket()
 
     try:
         # connect to the client
-        data_socket.connect((client_address, client_port))
-        print('[SERVER] Data connection established.')
-    except ConnectionRefusedError:
-        data_socket = None
+        await asyncio.get_running_loop().sock_connect(data_socket, client_address)
+    except OSError:
+        # e.g. connection refused, host unreachable or timed out
+        data_socket.close()
+        return None
 
-    return data_socket
+    logger.info('Data connection established.')
+
+    return await asyncio.open_connection(sock=data_socket, limit=DATA_BUFFER_SIZE)
+
+
+async def send_mapped_file(writer, file):
+    ''' Sends a file over the data connection straight from a read-only memory map
+
+    Arguments:
+        writer: stream writer of the data connection with the client
+        file: file opened in binary mode
+    '''
+
+    # an empty file cannot be mapped
+    if os.fstat(file.fileno()).st_size == 0:
+        return
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, \
+            memoryview(mapped_file) as view:
+        # write in chunks and wait for the transport after each one, so it
+        # never buffers more than about one chunk of the file in memory
+        for offset in range(0, len(view), DATA_BUFFER_SIZE):
+            writer.write(view[offset:offset + DATA_BUFFER_SIZE])
+            await writer.drain()
+
+        # the map must stay open until the transport has flushed every byte
+        writer.transport.set_write_buffer_limits(high=0)
+        await writer.drain()
+
+
+def resolve_path(arg, current_path):
+    ''' Creates a fully qualified absolute path from a path sent by the client
+
+    Arguments:
+        arg: path sent by the client, absolute from the server root if it starts with / or \\
+        current_path: current directory of the client relative to the server root
+
+    Returns:
+        str : absolute path in the file system
+    '''
+
+    sub_path = arg[1:] if arg.startswith(('/', '\\')) else os.path.join(
+        current_path[1:], arg)
 
+    return os.path.join(BASE_PATH, sub_path)
 
-def handle_unauthenticated(cnx):
+
+async def handle_unauthenticated(writer):
     ''' Sends status 530, closes the control connection and sets appropriate flags if not authenticated
 
     Arguments:
-        cnx: control socket connection with the client
+        writer: stream writer of the control connection with the client
     '''
 
-    send_message(cnx, '530 Not logged in.')
-    close_cnx(cnx)
+    await send_bytes(writer, REPLY_530_NOT_LOGGED_IN)
+    close_cnx(writer)
 
     connected = False
 
     return connected
 
 
-def handle_connected_client(cnx, addr):
-    ''' Handles the session between the server and the client
+@dataclass
+class Session:
+    ''' State of the session between the server and a client
+
+    Attributes:
+        writer: stream writer of the control connection with the client
+        username: username sent by the client
+        password: password sent by the client
+        client_address: (host, port) sent by the client for data communication
+        current_path: current directory relative to the server root
+        authenticated: flag to check if the client is authenticated
+        connected: flag to check if the client is connected
+    '''
+
+    writer: asyncio.StreamWriter
+    username: bytes | None = None
+    password: bytes | None = None
+    client_address: tuple[str, int] | None = None
+    current_path: str = '/'
+    authenticated: bool = False
+    connected: bool = True
+
+
+async def handle_opts(session, arg):
+    ''' Handles the OPTS command
 
     Arguments:
-        cnx: control socket connection with the client
-        addr: address of the connected client
+        session: session with the client
+        arg: argument sent with the command
     '''
 
-    # Welcome the connected client
-    send_message(cnx, '220 Welcome to myFTPserver!')
+    if not arg.startswith(b'UTF8'):
+        # send status 501 if argument does not start with UTF8
+        # other arguments not yet supported
+        await send_bytes(session.writer, REPLY_504_NOT_IMPLEMENTED_FOR_ARG)
 
-    username = None
-    password = None
+    # send status 200 if argument starts with UTF8
+    await send_bytes(session.writer, REPLY_200_OK)
 
-    # client address for data communication
-    client_info = None
-    # socket for full duplex connection over which data is transferred
-    data_socket = None
 
-    # server root directory
-    current_path = '/'
+async def handle_user(session, arg):
+    ''' Handles the USER command
 
-    # flag to check if a client is authenticated
-    authenticated = False
-    # flag to check if a client is connected
-    connected = True
+    Arguments:
+        session: session with the client
+        arg: username sent by the client
+    '''
 
-    while connected:
-        # when connected wait for message from the client
-        try:
-            message = cnx.recv(BUFFER_SIZE).decode(ENCODING).strip()
-        except ConnectionResetError:
-            close_cnx(cnx)
-            connected = False
-            continue
+    session.username = arg
+    # send status 331 and ask for password
+    await send_bytes(session.writer, REPLY_331_NEED_PASSWORD)
 
-        if not message:
-            close_cnx(cnx)
-            connected = False
-            continue
 
-        # print the whole received command
-        print(f'[SERVER] Received command : {message}')
+async def handle_pass(session, arg):
+    ''' Handles the PASS command
+
+    Arguments:
+        session: session with the client
+        arg: password sent by the client
+    '''
+
+    session.password = arg
+
+    if session.username == b'guest' and session.password == b'guest':
+        # send status 230 for successful login
+        await send_bytes(session.writer, REPLY_230_LOGGED_IN)
+        logger.info('USER authenticated.')
+
+        # set the authenticated flag
+        session.authenticated = True
+
+    else:
+        # clear username and password
+        session.username, session.password = None, None
+
+        # set appropriate flags
+        session.connected, session.authenticated = False, False
+
+        # send status 530 for failed authentication
+        await send_bytes(session.writer, REPLY_530_INCORRECT_CREDENTIALS)
+        # close the control conection
+        close_cnx(session.writer)
+
+
+async def handle_quit(session, arg):
+    ''' Handles the QUIT command
+
+    Arguments:
+        session: session with the client
+        arg: argument sent with the command (unused)
+    '''
+
+    # send status 221
+    await send_bytes(session.writer, REPLY_221_GOODBYE)
+    # close the control connection
+    close_cnx(session.writer)
+
+    session.connected = False
+    session.authenticated = False
+
+
+async def handle_xpwd(session, arg):
+    ''' Handles the XPWD command
+
+    Arguments:
+        session: session with the client
+        arg: argument sent with the command (unused)
+    '''
+
+    await send_bytes(session.writer, b''.join(
+        [b'257 Current directory: ', session.current_path.encode(ENCODING), b'\r\n']))
+
+
+async def handle_cwd(session, arg):
+    ''' Handles the CWD command
+
+    Arguments:
+        session: session with the client
+        arg: directory to change to
+    '''
+
+    # decode the path sent by the client; replies reuse the raw bytes
+    try:
+        path = arg.decode(ENCODING)
+    except UnicodeDecodeError:
+        # send status 501 if the path is not valid in the server encoding
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
+
+    # create a fully qualified absolute path with symbolic links resolved, so a
+    # link pointing outside the server root is caught by the check below
+    # the process working directory is shared by all clients, so it is never changed
+    navigating_path = pathlib.PurePath(os.path.realpath(
+        resolve_path(path, session.current_path)))
+
+    if not os.path.isdir(navigating_path):
+        # send status 550 if directory could not be changed
+        await send_bytes(session.writer, b''.join(
+            [b'550 ', arg, b' is not a directory.\r\n']))
+        return
+
+    # prevent navigating up from the root directory
+    # compares path components, so a sibling such as <root>2 is not taken for the root
+    if not navigating_path.is_relative_to(BASE_PURE_PATH):
+        # reset to the server root if user navigated below it
+        navigating_path = BASE_PURE_PATH
+
+    session.current_path = '/' if navigating_path == BASE_PURE_PATH else '/' + navigating_path.relative_to(
+        BASE_PURE_PATH).as_posix()
+
+    await send_bytes(session.writer, b''.join(
+        [b'250 Changed directory: ', session.current_path.encode(ENCODING), b'\r\n']))
+
+
+async def handle_dele(session, arg):
+    ''' Handles the DELE command
+
+    Arguments:
+        session: session with the client
+        arg: file to delete
+    '''
+
+    # decode the path sent by the client; replies reuse the raw bytes
+    try:
+        path = arg.decode(ENCODING)
+    except UnicodeDecodeError:
+        # send status 501 if the path is not valid in the server encoding
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
+
+    # create a fully qualified absolute path
+    file_path = resolve_path(path, session.current_path)
+
+    # if arg is not a file
+    if not os.path.isfile(file_path):
+        # send status 550
+        await send_bytes(session.writer, b''.join(
+            [b'550 ', arg, b' does not exist in ', session.current_path.encode(ENCODING), b' directory.\r\n']))
+        return
+
+    # delete the requested file
+    os.remove(file_path)
+
+    # send status 250 for successful deletion
+    await send_bytes(session.writer, b''.join([b'250 ', arg, b' deleted.\r\n']))
+
+
+async def handle_port(session, arg):
+    ''' Handles the PORT command
+
+    Arguments:
+        session: session with the client
+        arg: address sent by the client (h1,h2,h3,h4,p1,p2)
+    '''
+
+    fields = arg.split(b',')
 
-        # split the message into command and arguments
-        split_message = re.findall('^[A-Z]{3,4}(?=\s?)|(?<=\s).+', message)
-        command = split_message[0]
+    # send status 501 unless the address is exactly six numbers from 0 to 255
+    # int() alone would also accept signs, whitespace and underscores
+    if len(fields) != 6 or not all(field.isdigit() for field in fields):
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
 
-        # prevent exception when message has no arguments
-        # e.g. PWD command has no arguments
+    h1, h2, h3, h4, p1, p2 = map(int, fields)
+
+    if not all(0 <= number <= 255 for number in (h1, h2, h3, h4, p1, p2)):
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
+
+    # store the client address, parsed once for all following transfers
+    # client_address = h1.h2.h3.h4
+    # client_port = (p1 * 256) + p2
+    session.client_address = (f'{h1}.{h2}.{h3}.{h4}', (p1 << 8) | p2)
+
+    await send_bytes(session.writer, REPLY_200_COMMAND_SUCCESSFUL)
+
+
+async def handle_retr(session, arg):
+    ''' Handles the RETR command
+
+    Arguments:
+        session: session with the client
+        arg: file to send to the client
+    '''
+
+    # decode the path sent by the client; replies reuse the raw bytes
+    try:
+        path = arg.decode(ENCODING)
+    except UnicodeDecodeError:
+        # send status 501 if the path is not valid in the server encoding
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
+
+    # create a fully qualified absolute path
+    file_path = resolve_path(path, session.current_path)
+
+    # if requested file not found, send status 550
+    if not os.path.isfile(file_path):
+        await send_bytes(session.writer, b''.join(
+            [b'550 ', arg, b' does not exist in ', session.current_path.encode(ENCODING), b' directory.\r\n']))
+        return
+
+    # send status 503 if no PORT command gave an address to connect to
+    if session.client_address is None:
+        await send_bytes(session.writer, REPLY_503_BAD_SEQUENCE)
+        return
+
+    # establish a data connection with the client
+    data_cnx = await connect_to_client(session.client_address)
+
+    # send status 425 on connection failure
+    if not data_cnx:
+        await send_bytes(session.writer, REPLY_425_CANT_OPEN_DATA_CNX)
+        return
+
+    await send_bytes(session.writer, REPLY_150_ABOUT_TO_TRANSFER)
+
+    _, data_writer = data_cnx
+
+    # open and send the requested file
+    with open(file_path, 'rb') as file:
         try:
-            arg = split_message[1].strip()
-        except IndexError:
-            arg = ''
+            await asyncio.get_running_loop().sendfile(
+                data_writer.transport, file, fallback=False)
+        except asyncio.SendfileNotAvailableError:
+            # the transport has no native sendfile, e.g. a selector event loop on Windows
+            await send_mapped_file(data_writer, file)
 
-        # continue immediately if command is unsupported
-        if command not in SUPPORTED_COMMANDS:
-            send_message(cnx, '502 Command not implemented.')
-            continue
+    # close the data connection
+    data_writer.close()
+    await data_writer.wait_closed()
 
-        # handle OPTS command
-        if command == 'OPTS':
-            if not arg.startswith('UTF8'):
-                # send status 501 if argument does not start with UTF8
-                # other arguments not yet supported
-                send_message(
-                    cnx, '504 Command not implemented for that argument.')
+    logger.info('Successfully transferred %s.', path)
 
-            # send status 200 if argument starts with UTF8
-            send_message(cnx, '200 OK')
+    session.client_address = None
 
-            continue
+    await send_bytes(session.writer, b''.join(
+        [b'250 Successfully transferred ', arg, b'.\r\n']))
 
-        # handle USER command
-        elif command == 'USER':
 
-            username = arg
-            # send status 331 and ask for password
-            send_message(cnx, '331 Username OK, need password.')
+async def handle_stor(session, arg):
+    ''' Handles the STOR command
 
-            continue
+    Arguments:
+        session: session with the client
+        arg: name of the file received from the client
+    '''
 
-        # handle PASS command
-        elif command == 'PASS':
+    # decode the path sent by the client; replies reuse the raw bytes
+    try:
+        path = arg.decode(ENCODING)
+    except UnicodeDecodeError:
+        # send status 501 if the path is not valid in the server encoding
+        await send_bytes(session.writer, REPLY_501_SYNTAX_ERROR)
+        return
 
-            password = arg
+    # create a fully qualified absolute path
+    file_path = resolve_path(path, session.current_path)
 
-            if username == 'guest' and password == 'guest':
-                # send status 230 for successful login
-                send_message(cnx, '230 Login successful.')
-                print('[SERVER] USER authenticated.')
+    # if file already exists, send status 553
+    if os.path.isfile(file_path):
+        await send_bytes(session.writer, b''.join(
+            [b'553 Requested action not taken. ', arg, b' name already taken.\r\n']))
+        return
 
-                # set the authenticated flag
-                authenticated = True
+    # send status 503 if no PORT command gave an address to connect to
+    if session.client_address is None:
+        await send_bytes(session.writer, REPLY_503_BAD_SEQUENCE)
+        return
 
-            else:
-                # clear username and password
-                username, password = None, None
+    # establish a data connection with the client
+    data_cnx = await connect_to_client(session.client_address)
 
-                # set appropriate flags
-                connected, authenticated = False, False
+    # send status 425 on connection failure
+    if not data_cnx:
+        await send_bytes(session.writer, REPLY_425_CANT_OPEN_DATA_CNX)
+        return
 
-                # send status 530 for failed authentication
-                send_message(cnx, '530 Not logged in. Incorrect credentials.')
-                # close the control conection
-                close_cnx(cnx)
+    await send_bytes(session.writer, REPLY_150_ABOUT_TO_TRANSFER)
 
-            continue
+    data_reader, data_writer = data_cnx
 
-        # handle QUIT command
-        elif command == 'QUIT':
-            # send status 221
-            send_message(cnx, '221 Goodbye.')
-            # close the control connection
-            close_cnx(cnx)
+    loop = asyncio.get_running_loop()
 
-            connected = False
-            authenticated = False
-            continue
+    # save the incoming file, copying in large chunks until the client closes the connection
+    # disk writes run in the worker pool so they do not stall the other clients
+    with open(file_path, 'wb') as file:
+        while data := await data_reader.read(DATA_BUFFER_SIZE):
+            await loop.run_in_executor(None, file.write, data)
 
-        # commands below this requires authenticated user
-        if not authenticated:
-            connected = handle_unauthenticated(cnx)
-            continue
+    # close the data connection once all bytes are received
+    data_writer.close()
+    await data_writer.wait_closed()
+    logger.info('Received %s', path)
 
-        # handle XPWD command
-        if command == 'XPWD':
-            send_message(
-                cnx, f'257 Current directory: {current_path}')
-            continue
+    logger.info('Successfully saved %s in %s.', path, session.current_path)
 
-        # handle CWD command
-        elif command == 'CWD':
-            # create a fully qualified absolute path
-            path = os.path.join(BASE_PATH, arg[1:]) if arg[:1] in [
-                '/', '\\'] else os.path.join(BASE_PATH, current_path[1:], arg)
-
-            try:
-                # try changing to the absolute path
-                os.chdir(path)
-            except (FileNotFoundError, NotADirectoryError):
-                # send status 550 if directory could not be changed
-                send_message(cnx, f'550 {arg} is not a directory.')
-            else:
-                # get the current directory
-                navigating_path = os.getcwd()
-
-                # prevent navigating up from the root directory
-                if BASE_PATH not in navigating_path:
-                    # change to BASE_PATH if user navigated below the server root
-                    os.chdir(BASE_PATH)
-
-                    navigating_path = BASE_PATH
-                    # reset current_path to server root
-                    current_path = '/'
-
-                current_path = '/' if navigating_path == BASE_PATH else navigating_path.removeprefix(
-                    BASE_PATH)
-
-                send_message(
-                    cnx, f'250 Changed directory: {current_path}')
+    await send_bytes(session.writer, b''.join(
+        [b'250 Successfully transferred ', arg, b'.\r\n']))
 
-            continue
 
-        # handle DELE command
-        elif command == 'DELE':
+# handler for each supported command, called with the session and the argument as bytes
+COMMAND_HANDLERS = {
+    b'OPTS': handle_opts,
+    b'USER': handle_user,
+    b'PASS': handle_pass,
+    b'QUIT': handle_quit,
+    b'XPWD': handle_xpwd,
+    b'CWD': handle_cwd,
+    b'DELE': handle_dele,
+    b'PORT': handle_port,
+    b'RETR': handle_retr,
+    b'STOR': handle_stor,
+}
+
 
-            # create a fully qualified absolute path
-            file_path = os.path.join(BASE_PATH, arg[1:]) if arg[:1] in [
-                '/', '\\'] else os.path.join(BASE_PATH, current_path[1:], arg)
+async def handle_connected_client(reader, writer):
+    ''' Handles the session between the server and the client
 
-            # if arg is not a file
-            if not os.path.isfile(file_path):
-                # reset file_path
-                file_path = ''
-                # send status 550 and continue
-                send_message(
-                    cnx, f'550 {arg} does not exist in {current_path} directory.')
-                continue
+    Arguments:
+        reader: stream reader of the control connection with the client
+        writer: stream writer of the control connection with the client
+    '''
 
-            # delete the requested file
-            os.remove(file_path)
-            file_path = ''
+    global active_connections
 
-            # send status 250 for successful deletion
-            send_message(cnx, f'250 {arg} deleted.')
-            continue
+    active_connections += 1
 
-        # handle PORT command
-        elif command == 'PORT':
-            # store the client address
-            client_info = arg.split(',')
+    # everything after the increment runs inside try, so the count is always restored
+    try:
+        addr = writer.get_extra_info('peername')
 
-            send_message(cnx, f'200 Command successful.')
-            continue
+        # disable Nagle's algorithm; commands and replies are small and strictly alternate
+        writer.get_extra_info('socket').setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.info('[NEW CONNECTION] : %s connected.', addr)
+        logger.info('[ACTIVE CONNECTIONS] : %d', active_connections)
+
+        await serve_client(reader, writer)
+    finally:
+        active_connections -= 1
+
+
+async def serve_client(reader, writer):
+    ''' Exchanges commands and replies with the client until it disconnects
+
+    Arguments:
+        reader: stream reader of the control connection with the client
+        writer: stream writer of the control connection with the client
+    '''
 
-        # handle RETR command
-        elif command == 'RETR':
-            # create a fully qualified absolute path
-            file_path = os.path.join(BASE_PATH, arg[1:]) if arg[:1] in [
-                '/', '\\'] else os.path.join(BASE_PATH, current_path[1:], arg)
+    # Welcome the connected client
+    await send_bytes(writer, REPLY_220_WELCOME)
 
-            # if requested file not found, send status 550 and continue
-            if not os.path.isfile(file_path):
-                file_path = ''
-                send_message(
-                    cnx, f'550 {arg} does not exist in {current_path} directory.')
-                continue
+    session = Session(writer)
 
-            # establish a data connection with the client
-            data_socket = connect_to_client(client_info)
+    while session.connected:
+        # when connected wait for message from the client
+        try:
+            data = await reader.read(CONTROL_BUFFER_SIZE)
+        except ConnectionResetError:
+            # a reset ends the session just like the client closing the connection
+            data = b''
 
-            # send status 425 on connection failure
-            if not data_socket:
-                send_message(cnx, '425 Can\'t open data connection.')
-                continue
+        message = data.strip()
 
-            send_message(
-                cnx, '150 File status okay; about to begin transfer.')
+        if not message:
+            close_cnx(writer)
+            break
 
-            # open and send the requested file
-            with open(file_path, 'rb') as file:
-                data_socket.sendfile(file)
-                # close the data connection socket
-                data_socket.close()
+        # log the whole received command, decoding it only if it is going to be logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Received command : %s',
+                        message.decode(ENCODING, 'replace'))
 
-            print(f'[SERVER] Successfully transferred {arg}.')
+        # split the message into command and arguments, both still bytes
+        # arg is empty when the command has no arguments e.g. XPWD
+        command, _, arg = message.partition(b' ')
+        command = command.upper()
+        arg = arg.strip()
 
-            client_info = None
-            data_socket = None
-            file_path = ''
+        handler = COMMAND_HANDLERS.get(command)
 
-            send_message(cnx, f'250 Successfully transferred {arg}.')
+        # continue immediately if command is unsupported
+        if handler is None:
+            await send_bytes(writer, REPLY_502_NOT_IMPLEMENTED)
             continue
 
-        # handle STOR command
-        elif command == 'STOR':
-            # create a fully qualified absolute path
-            file_path = os.path.join(BASE_PATH, arg[1:]) if arg[:1] in [
-                '/', '\\'] else os.path.join(BASE_PATH, current_path[1:], arg)
+        # commands other than these require an authenticated user
+        if command not in UNAUTHENTICATED_COMMANDS and not session.authenticated:
+            session.connected = await handle_unauthenticated(writer)
+            continue
 
-            # if file already exists, send status 553
-            if os.path.isfile(file_path):
-                send_message(
-                    cnx, f'553 Requested action not taken. {arg} name already taken.')
-                file_path = ''
-                continue
+        await handler(session, arg)
 
-            # establish a data connection with the client
-            data_socket = connect_to_client(client_info)
 
-            # send status 425 on connection failure
-            if not data_socket:
-                send_message(cnx, '425 Can\'t open data connection.')
-                continue
+async def serve():
+    ''' Accepts connections on the control socket and handles each client in its own task '''
 
-            send_message(
-                cnx, '150 File status okay; about to begin transfer.')
+    # bounded pool of reused threads for blocking file system calls
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(
+        max_workers=FILE_IO_WORKERS, thread_name_prefix='ftp'))
 
-            # save the incoming file
-            with open(file_path, 'wb') as file:
-                while True:
-                    # receive and write bytes to file
-                    data = data_socket.recv(BUFFER_SIZE)
-                    file.write(data)
+    # start listening for connections
+    server = await asyncio.start_server(handle_connected_client, sock=control_socket)
+    logger.info('Listening on address %s:%d', ADDRESS, PORT)
 
-                    if not data:
-                        # close the data connection if all bytes received
-                        data_socket.close()
-                        print(f'[SERVER] Received {arg}')
-                        break
+    async with server:
+        await server.serve_forever()
 
-            print(f'[SERVER] Successfully saved {arg} in {current_path}.')
 
-            file_path = ''
+def start_logging():
+    ''' Sends log records through log_queue and starts the thread writing them to stdout
+
+    Returns:
+        QueueListener : started listener, to be stopped when the server exits
+    '''
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('[SERVER] %(message)s'))
+
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    return listener
 
-            send_message(cnx, f'250 Successfully transferred {arg}.')
-            continue
+
+def clear_screen():
+    ''' Clears the terminal the server was started in, if there is one '''
+
+    # nothing to clear when the output is redirected to a file or a pipe
+    if not sys.stdout.isatty():
+        return
+
+    if os.name == 'nt':
+        # classic Windows consoles print ANSI escapes literally unless virtual
+        # terminal processing is enabled, which Python does not do
+        os.system('cls')
+    else:
+        # clear the terminal without spawning a shell
+        sys.stdout.write('\x1b[2J\x1b[H')
+        sys.stdout.flush()
 
 
 def start_ftp_server():
-    print('[SERVER] Starting...')
+    # sched_setaffinity only pins the calling thread, but threads inherit the mask of the
+    # thread that creates them; pin before the logging and file I/O threads are started
+    # sched_setaffinity is only available on Linux
+    pinned = SERVER_CPU is not None and hasattr(os, 'sched_setaffinity')
+    if pinned:
+        os.sched_setaffinity(0, {int(SERVER_CPU)})
 
-    # start listening for connections
-    control_socket.listen()
-    print(f'[SERVER] Listening on address {ADDRESS}:{PORT}')
+    listener = start_logging()
 
-    while True:
-        # accept any incoming connections
-        cnx, addr = control_socket.accept()
+    logger.info('Starting...')
 
-        # handle the connected client in a new thread
-        thread = threading.Thread(
-            target=handle_connected_client, args=(cnx, addr))
-        thread.start()
+    if pinned:
+        logger.info('Pinned to CPU %s', SERVER_CPU)
 
-        print(f"[SERVER] [NEW CONNECTION] : {addr} connected.")
-        print(
-            f'[SERVER] [ACTIVE CONNECTIONS] : {threading.active_count() - 1}')
+    try:
+        asyncio.run(serve())
+    finally:
+        # flush the queued log records
+        listener.stop()
 
 
 # only allow execution as the main program
 if __name__ == '__main__':
 
-    os.system('cls')
+    clear_screen()
 
     start_ftp_server()